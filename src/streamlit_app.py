@@ -1,7 +1,11 @@
 # Import python packages
+import functools
+import time
 import streamlit as st
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
 from snowflake.snowpark.context import get_active_session
+from snowflake.snowpark.exceptions import SnowparkSQLException
 
 # Write directly to the app
 st.title("Widget reuse demo")
@@ -10,6 +14,205 @@ st.write("""Let's reuse some widgets!""")
 # Get the current credentials
 session = get_active_session()
 
+def _quote_identifier(name:str):
+    """
+    Quotes a Snowflake identifier, escaping any double quotes inside it
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+def _quote_literal(value:str):
+    """
+    Quotes a Snowflake string literal. Backslashes are escape characters in these, so they are escaped along with single quotes
+    """
+    return "'" + value.replace('\\', '\\\\').replace("'", "''") + "'"
+
+_SHOW_SCHEMAS_SQL = 'show terse schemas in database {database}'
+_SHOW_DATABASE_OBJECTS_SQL = 'show terse objects in database {database}'
+_SHOW_SCHEMA_OBJECTS_SQL = 'show terse objects in schema {database}.{schema}'
+_SHOW_SCHEMA_OBJECTS_STARTING_WITH_SQL = "show terse objects in schema {database}.{schema} starts with {prefix} limit 1000"
+
+# this script runs as __main__, so its session state keys are namespaced explicitly
+_STATE_KEY_PREFIX = "streamlit_app"
+_METADATA_TTL = 300
+
+# Metadata lookups are cached across reruns, so that widget interactions don't each
+# pay for a round trip to Snowflake. Only the names are kept, rather than Snowpark Rows.
+@st.cache_data(ttl=_METADATA_TTL, show_spinner=False)
+def _list_databases():
+    return [d['name'] for d in session.sql('show terse databases').collect()]
+
+_TABLE_KINDS = ('TABLE','VIEW')
+# show commands return at most 10,000 rows
+_CATALOG_ROW_LIMIT = 9999
+_METADATA_OPTIONS_STATE_KEY = f"{_STATE_KEY_PREFIX}_METADATA_OPTIONS"
+
+@st.cache_data(ttl=_METADATA_TTL, show_spinner=False)
+def _list_db_catalog(database:str):
+    """
+    Returns a dict of schema -> table names for every table and view in the database, using a single bulk query.
+    Returns None if the database has too many objects for one show command, in which case
+    schemas and tables are listed individually instead.
+    """
+    try:
+        objects = session.sql(_SHOW_DATABASE_OBJECTS_SQL.format_map({
+                'database': _quote_identifier(database)
+            })).collect()
+    except SnowparkSQLException:
+        return None
+    if len(objects) > _CATALOG_ROW_LIMIT:
+        return None
+    catalog:Dict[str,List[str]] = {}
+    for o in objects:
+        if o['kind'] in _TABLE_KINDS:
+            catalog.setdefault(o['schema_name'], []).append(o['name'])
+    return catalog
+
+@st.cache_data(ttl=_METADATA_TTL, show_spinner=False)
+def _list_schemas(database:str):
+    """
+    Returns the schemas containing tables or views, from the database catalog if it is available
+    """
+    catalog = _list_db_catalog(database)
+    if catalog is not None:
+        return list(catalog.keys())
+    return [s['name'] for s in session.sql(_SHOW_SCHEMAS_SQL.format_map({
+            'database': _quote_identifier(database)
+        })).collect()]
+
+@st.cache_data(ttl=_METADATA_TTL, show_spinner=False)
+def _list_tables(database:str, schema:str, prefix:str):
+    """
+    Returns the tables and views in the schema. When a prefix is given, Snowflake filters
+    the objects by name, otherwise the database catalog is used if it is available.
+    """
+    if prefix == '':
+        catalog = _list_db_catalog(database)
+        if catalog is not None:
+            return catalog.get(schema, [])
+        sql = _SHOW_SCHEMA_OBJECTS_SQL
+    else:
+        sql = _SHOW_SCHEMA_OBJECTS_STARTING_WITH_SQL
+    return [o['name'] for o in session.sql(sql.format_map({
+            'database': _quote_identifier(database),
+            'schema': _quote_identifier(schema),
+            'prefix': _quote_literal(prefix)
+        })).collect() if o['kind'] in _TABLE_KINDS]
+
+def _fresh_options(key:Hashable, variant:Optional[str] = None):
+    """
+    Returns the selectbox options kept in session state, or None if they haven't been fetched for this variant
+    or are older than the cache TTL. Expired options are dropped, so that session state doesn't keep every lookup made.
+    """
+    metadata_options = st.session_state.get(_METADATA_OPTIONS_STATE_KEY, {})
+    if key not in metadata_options:
+        return None
+    fetched_at, options_variant, options = metadata_options[key]
+    if time.monotonic() - fetched_at > _METADATA_TTL:
+        del metadata_options[key]
+        return None
+    if options_variant != variant:
+        return None
+    return options
+
+def _store_options(key:Hashable, names:List[str], variant:Optional[str] = None, selected:Optional[str] = None):
+    """
+    Keeps selectbox options in session state, as a tuple led by None.
+    Only the latest variant is kept for each key. A selected value which isn't in names is added to the end.
+    """
+    if _METADATA_OPTIONS_STATE_KEY not in st.session_state:
+        st.session_state[_METADATA_OPTIONS_STATE_KEY] = {}
+    options = (None,) + tuple(names)
+    if selected is not None and selected not in options:
+        options = options + (selected,)
+    st.session_state[_METADATA_OPTIONS_STATE_KEY][key] = (time.monotonic(), variant, options)
+    return options
+
+def _options_for_session(key:Hashable, fetch:Callable[[], List[str]],
+                         variant:Optional[str] = None, selected:Optional[str] = None):
+    """
+    Returns selectbox options from session state, so that repeated renders don't even hit the cache,
+    and each lookup runs at most once per run however many choosers need it.
+    The options are kept as a tuple led by None, built once rather than on every rerun.
+    They are fetched again once they are older than the metadata cache TTL, so new objects still appear.
+    variant distinguishes lookups sharing a key, such as table name prefixes, of which only the latest is kept.
+    selected is kept available in the options, even if the lookup doesn't return it.
+    """
+    options = _fresh_options(key, variant)
+    if options is None or (selected is not None and selected not in options):
+        options = _store_options(key, fetch(), variant, selected)
+    return options
+
+def _run_lookups(lookups:Dict[Hashable, Callable[[], List[str]]]):
+    """
+    Runs a group of lookups one after another, on a prefetch thread
+    """
+    return {key: lookup() for key, lookup in lookups.items()}
+
+def prefetch_metadata(specs:List[Tuple[Optional[str],Optional[str],str]]):
+    """
+    Fetches the options for the table choosers about to render at once, on a thread pool so that the queries overlap.
+    specs is a list of (database, schema, table name prefix) selections, where database and schema may be None.
+    Options already in session state are skipped, so the queries only overlap when several lookups are stale together,
+    after a refresh or once they expire. The lookups for one database run together on one thread, since they share its catalog.
+    A lookup which fails is left for its chooser to run again, and report.
+    """
+    lookup_groups:Dict[Optional[str], Dict[Hashable, Callable[[], List[str]]]] = {}
+    if _fresh_options(('databases',)) is None:
+        lookup_groups[None] = {('databases',): _list_databases}
+    for database, schema, table_prefix in specs:
+        if database is None:
+            continue
+        if _fresh_options(('schemas', database)) is None:
+            lookup_groups.setdefault(database, {})[('schemas', database)] = \
+                functools.partial(_list_schemas, database)
+        if schema is not None and _fresh_options(('tables', database, schema), table_prefix) is None:
+            lookup_groups.setdefault(database, {})[('tables', database, schema, table_prefix)] = \
+                functools.partial(_list_tables, database, schema, table_prefix)
+    # with a single group there is nothing to overlap, so the choosers fetch as they render
+    if len(lookup_groups) < 2:
+        return
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(_run_lookups, lookups) for lookups in lookup_groups.values()]
+    # session state is only written here, on the script's own thread
+    for future in futures:
+        if future.exception() is None:
+            for key, names in future.result().items():
+                if key[0] == 'tables':
+                    _store_options(key[:3], names, key[3])
+                else:
+                    _store_options(key, names)
+
+# the second chooser's initial selection
+_SECOND_TABLE_DATABASE = 'SCRATCH'
+_SECOND_TABLE_SCHEMA = 'PUBLIC'
+_SECOND_TABLE = 'CUSTOMERS'
+
+# previews start small so the first rows arrive quickly, and grow on request
+_PREVIEW_ROWS = 200
+_ROWS_SHOWN_STATE_KEY = f"{_STATE_KEY_PREFIX}_ROWS_SHOWN"
+_CHOSEN_TABLES_STATE_KEY = f"{_STATE_KEY_PREFIX}_CHOSEN_TABLES"
+# each chooser's last (database, schema, table name prefix) selection, which the next run prefetches
+_CHOSEN_SELECTIONS_STATE_KEY = f"{_STATE_KEY_PREFIX}_CHOSEN_SELECTIONS"
+
+def _fetch_preview(full_table_name:str, rows:int):
+    """
+    Fetches the first rows of a table into a pandas DataFrame, for display
+    """
+    return session.table(full_table_name).limit(rows).to_pandas()
+
+def _load_more_rows():
+    st.session_state[_ROWS_SHOWN_STATE_KEY] = st.session_state.get(_ROWS_SHOWN_STATE_KEY, _PREVIEW_ROWS) + _PREVIEW_ROWS
+
+def _refresh_metadata():
+    """
+    Discards the cached metadata, so that the next run fetches it from Snowflake again
+    """
+    _list_databases.clear()
+    _list_schemas.clear()
+    _list_db_catalog.clear()
+    _list_tables.clear()
+    st.session_state.pop(_METADATA_OPTIONS_STATE_KEY, None)
+
 from widget_base import WidgetBase
 WidgetBase.prepare()
 
@@ -29,6 +232,9 @@ else:
         - initial_database: Pre-select the database
         - initial_schema: Pre-select the schema
         - initial_table: Pre-select the table
+        - named_instance: Distinguishes choosers constructed in different fragments
+
+        A "starts with" field narrows the table list, which is filtered by Snowflake
         
         The following attributes are available after initialization:
         - selected_database
@@ -39,39 +245,49 @@ else:
         def __init__(self,
                     initial_database:Optional[str] = None,
                     initial_schema:Optional[str] = None,
-                    initial_table:Optional[str] = None):
-            WidgetBase.__init__(self)
-            self._apply_session_state_defaults(
-                {
-                    "database":initial_database,
-                    "schema": initial_schema,
-                    "table": initial_table
-                }
-            )
+                    initial_table:Optional[str] = None,
+                    named_instance:Optional[str] = None):
+            WidgetBase.__init__(self, named_instance)
+            defaults = {
+                "database":initial_database,
+                "schema": initial_schema,
+                "table": initial_table,
+                "table_prefix": ""
+            }
+            # this default only matters the first time the widget is constructed
+            if self._full_key("show_selection") not in st.session_state:
+                defaults["show_selection"] = initial_database is None or \
+                                            initial_schema is None or \
+                                            initial_table is None
+            self._apply_session_state_defaults(defaults)
             self.selected_database = self._get_session_state('database')
             self.selected_schema = self._get_session_state('schema')
             self.selected_table = self._get_session_state('table')
-            self.full_table_name = None
-            self._apply_session_state_defaults(
-                {
-                    "show_selection": initial_database is None or \
-                                    initial_schema is None or \
-                                    initial_table is None
-                }
-            )
+            self.table_prefix = self._get_session_state('table_prefix') or ''
             self.show_selection = self._get_session_state('show_selection')
-            self.databases = [None] + [d['name'] for d in session.sql('show databases').collect()]
+            self.full_table_name = None
+            # the selectbox options are kept in session state as tuples, so they aren't rebuilt on every rerun
+            self.databases = _options_for_session(('databases',), _list_databases)
             if self.selected_database is None:
                 return
-            self.schemas = [None] + [s['name'] for s in session.sql(f"""
-                    show schemas in database "{self.selected_database}"
-                    """).collect()]
+            # the schema names are remembered for the database they were fetched for,
+            # so they are only fetched again when the database changes or they expire
+            self.schemas = _options_for_session(
+                ('schemas', self.selected_database),
+                lambda: _list_schemas(self.selected_database))
             if self.selected_schema is None:
                 return
-            self.tables = [None] + [t['name'] for t in session.sql(f"""
-                show tables in schema "{self.selected_database}"."{self.selected_schema}"
-                """).collect()]
-            self.full_table_name = f'"{self.selected_database}"."{self.selected_schema}"."{self.selected_table}"'
+            # only the latest prefix is kept for each schema, and the current selection stays available
+            # even if the prefix no longer matches it
+            self.tables = _options_for_session(
+                ('tables', self.selected_database, self.selected_schema),
+                lambda: _list_tables(self.selected_database, self.selected_schema, self.table_prefix),
+                variant=self.table_prefix,
+                selected=self.selected_table)
+            qdb = _quote_identifier(self.selected_database)
+            qschema = _quote_identifier(self.selected_schema)
+            qtable = _quote_identifier(str(self.selected_table))
+            self.full_table_name = f"{qdb}.{qschema}.{qtable}"
             
         def handle_change_selection(self):
             self._set_session_state('show_selection',True)
@@ -104,6 +320,11 @@ else:
                     st.write('Please select a schema')
                     return
                 
+                st.text_input(
+                    label="Table name starts with",
+                    key=self._full_key("table_prefix"),
+                    help="Case-sensitive. Leave empty to list every table in the schema")
+
                 st.selectbox(
                     label="Table",
                     key=self._full_key("table"),
@@ -126,21 +347,78 @@ else:
             
             
     
-    st.subheader('Select the first table')
-    table_1_chooser = TableChooser()
-    table_1_chooser.render()
-    if table_1_chooser.full_table_name is not None:
-        table_1_data = session.table(table_1_chooser.full_table_name)
-        st.subheader('Select the second table')
+    st.button(label='Refresh',
+              help='Reload the lists of databases, schemas and tables',
+              on_click=_refresh_metadata)
+    # the metadata for the choosers about to render is fetched together, from their last selections.
+    # The second chooser only renders once a first table has been chosen, starting from its initial selection.
+    chosen_selections = st.session_state.get(_CHOSEN_SELECTIONS_STATE_KEY, {})
+    prefetch_specs = [chosen_selections.get('first', (None, None, ''))]
+    if st.session_state.get(_CHOSEN_TABLES_STATE_KEY, {}).get('first') is not None:
+        prefetch_specs.append(chosen_selections.get('second', (_SECOND_TABLE_DATABASE, _SECOND_TABLE_SCHEMA, '')))
+    prefetch_metadata(prefetch_specs)
+
+    def publish_table_name(name:str, chooser:TableChooser):
+        """
+        Records the table chosen inside a fragment. Fragments rerun on their own, so if the choice
+        has changed, the whole app is rerun to let everything downstream of the chooser see it.
+        The previews also go back to their initial size, so the new table's first rows arrive quickly.
+        The chooser's selection is recorded too, so that the next run prefetches its metadata.
+        """
+        if _CHOSEN_SELECTIONS_STATE_KEY not in st.session_state:
+            st.session_state[_CHOSEN_SELECTIONS_STATE_KEY] = {}
+        st.session_state[_CHOSEN_SELECTIONS_STATE_KEY][name] = \
+            (chooser.selected_database, chooser.selected_schema, chooser.table_prefix)
+        full_table_name = chooser.full_table_name
+        if _CHOSEN_TABLES_STATE_KEY not in st.session_state:
+            st.session_state[_CHOSEN_TABLES_STATE_KEY] = {}
+        chosen_tables = st.session_state[_CHOSEN_TABLES_STATE_KEY]
+        previous_table_name = chosen_tables.get(name, full_table_name)
+        chosen_tables[name] = full_table_name
+        if previous_table_name != full_table_name:
+            st.session_state.pop(_ROWS_SHOWN_STATE_KEY, None)
+            st.rerun()
+
+    # Each chooser is a fragment, so changing a chooser's database, schema or prefix, or pressing Change,
+    # only reruns that chooser. Picking a table reruns the whole app, so that the previews follow it.
+    # Streamlit doesn't keep a fragment's return value when it reruns on its own,
+    # so the chosen tables are read from session state instead.
+    @st.fragment
+    def choose_first_table():
+        WidgetBase.prepare_fragment('first')
+        table_1_chooser = TableChooser(named_instance='first')
+        table_1_chooser.render()
+        publish_table_name('first', table_1_chooser)
+
+    @st.fragment
+    def choose_second_table():
+        WidgetBase.prepare_fragment('second')
         table_2_chooser = TableChooser(
-            initial_database='SCRATCH',
-            initial_schema='PUBLIC',
-            initial_table='CUSTOMERS'
+            initial_database=_SECOND_TABLE_DATABASE,
+            initial_schema=_SECOND_TABLE_SCHEMA,
+            initial_table=_SECOND_TABLE,
+            named_instance='second'
         )
         table_2_chooser.render()
-        if table_2_chooser.full_table_name is not None:
-            table_2_data = session.table(table_2_chooser.full_table_name)
-        
+        publish_table_name('second', table_2_chooser)
+
+    st.subheader('Select the first table')
+    choose_first_table()
+    table_1_name = st.session_state.get(_CHOSEN_TABLES_STATE_KEY, {}).get('first')
+    if table_1_name is not None:
+        st.subheader('Select the second table')
+        choose_second_table()
+        table_2_name = st.session_state.get(_CHOSEN_TABLES_STATE_KEY, {}).get('second')
+        if table_2_name is not None:
+            rows_shown = st.session_state.get(_ROWS_SHOWN_STATE_KEY, _PREVIEW_ROWS)
+            # the two tables are independent, so they are fetched at the same time
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                table_1_future = executor.submit(_fetch_preview, table_1_name, rows_shown)
+                table_2_future = executor.submit(_fetch_preview, table_2_name, rows_shown)
+                table_1_data, table_2_data = table_1_future.result(), table_2_future.result()
         
             st.dataframe(table_1_data, use_container_width=True)
             st.dataframe(table_2_data, use_container_width=True)
+            st.button(label='Load more',
+                      help=f'Show another {_PREVIEW_ROWS} rows of each table',
+                      on_click=_load_more_rows)
@@ -3,16 +3,52 @@ Widgets!
 """
 from __future__ import annotations
 from abc import ABC
-from typing import List, Literal, Optional, Set
+from typing import List, Literal, Optional, Tuple
+import functools
 import inspect
 import os
-from typing import Callable, Dict, TypeVar
+import sys
+from typing import Callable, Dict, Iterable, TypeVar
 import streamlit as st
 
 T = TypeVar("T")
-_PERSIST_STATE_KEY = f"{__name__}_PERSIST"
+# the full keys which have been used by widgets in this session, indexed by key prefix.
+# Each key maps to whether it is persisted by prepare().
+_KEY_INDEX_KEY = f"{__name__}_KEY_INDEX"
+
+# the number of siblings seen so far in this session's run, keyed by (child prefix, class name, named part).
+# These are kept in session state, since sessions run concurrently.
+_SIBLING_COUNTERS_KEY = f"{__name__}_SIBLING_COUNTERS"
+# counts full executions of the script, so that a fragment can tell whether it is running on its own
+_RUN_KEY = f"{__name__}_RUN"
+# the sibling counters as they were when each fragment started in the last full execution, with that execution's run
+_FRAGMENT_COUNTERS_KEY = f"{__name__}_FRAGMENT_COUNTERS"
+
+# source files of widget classes, keyed by (module, qualified name) rather than by the class itself,
+# since classes defined in the script are created again on every rerun
+_class_source_files:Dict[Tuple[str, str], Optional[str]] = {}
+
+def _class_source_file(cls: type) -> Optional[str]:
+    """
+    Returns the source file a widget class was defined in
+    """
+    class_name = (cls.__module__, cls.__qualname__)
+    if class_name not in _class_source_files:
+        _class_source_files[class_name] = inspect.getsourcefile(cls)
+    return _class_source_files[class_name]
 
-used_key_prefixes:Set[str] = set()
+@functools.lru_cache(maxsize=None)
+def _launch_directory() -> Optional[str]:
+    """
+    Returns the directory of the Launch.py script further up the stack, if there is one.
+    This doesn't change while the app is running, so it is only looked up once.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_filename.endswith("Launch.py"):
+            return os.path.dirname(frame.f_code.co_filename)
+        frame = frame.f_back
+    return None
 
 class WidgetBase(ABC):
     """
@@ -37,50 +73,101 @@ class WidgetBase(ABC):
         This class method should be ran by the main streamlit script on each execution.
         It clears the state of which key prefixes have been used, so that they each end up with the same key prefixes each time.
         """
-        used_key_prefixes.clear()
-        # we have to rewrite all the session state entries to prevent them being deleted if its field isn't rendered
-        if _PERSIST_STATE_KEY in st.session_state:
+        st.session_state[_SIBLING_COUNTERS_KEY] = {}
+        st.session_state[_RUN_KEY] = st.session_state.get(_RUN_KEY, 0) + 1
+        # we have to rewrite all the session state entries to prevent them being deleted if its field isn't rendered.
+        # The keys to persist are the union of those registered by each widget prefix, so unrelated session state isn't visited.
+        key_index = st.session_state.get(_KEY_INDEX_KEY)
+        if key_index:
             st.session_state.update({
-                key: value
-                for key, value in st.session_state.items()
-                if key in st.session_state[_PERSIST_STATE_KEY]
+                key: st.session_state[key]
+                for keys in key_index.values()
+                for key, persist in keys.items()
+                if persist and key in st.session_state
             })
 
+    @classmethod
+    def prepare_fragment(cls, fragment_name: str):
+        """
+        This class method should be ran at the start of each st.fragment function which constructs widgets,
+        with a name unique to the fragment.
+        A fragment can rerun without the rest of the script, so its widgets need the sibling counts they started from in the last full run.
+        These are saved when the fragment runs as part of a full run, and restored when it reruns on its own,
+        so that its widgets get the same key prefixes either way and widgets constructed after it aren't affected.
+        """
+        run = st.session_state.get(_RUN_KEY, 0)
+        fragment_counters = st.session_state.setdefault(_FRAGMENT_COUNTERS_KEY, {})
+        saved = fragment_counters.get(fragment_name)
+        if saved is not None and saved[0] == run:
+            st.session_state[_SIBLING_COUNTERS_KEY] = dict(saved[1])
+        else:
+            fragment_counters[fragment_name] = (run, dict(st.session_state.setdefault(_SIBLING_COUNTERS_KEY, {})))
+
     def __init__(self, named_instance: Optional[str] = None):
         self._key_prefix: str = ""
+        self._full_keys: Dict[str, str] = {}
         # We go up the stack until there are no more WidgetBase instances
         # The idea is that each instance of a component can derive its key from the path it took to get here
         #st.write(inspect.stack())
         named_instance_used = False
-        for frame in inspect.stack():
-            if "self" in frame.frame.f_locals:
-                frame_class = frame.frame.f_locals["self"].__class__
+        # Frames are walked directly rather than via inspect.stack(), which reads the source context of every frame.
+        # This frame counts the instance itself. If the caller is a subclass constructor forwarding to
+        # WidgetBase.__init__(self), it is skipped so that the instance isn't counted twice.
+        sibling_counters = st.session_state.setdefault(_SIBLING_COUNTERS_KEY, {})
+        own_frame = sys._getframe()
+        forwarding_frame = own_frame.f_back
+        if forwarding_frame is not None and (forwarding_frame.f_code.co_name != "__init__"
+                                             or forwarding_frame.f_locals.get("self") is not self):
+            forwarding_frame = None
+        frame = own_frame
+        while frame is not None:
+            if "self" in frame.f_locals:
+                frame_class = frame.f_locals["self"].__class__
                 if issubclass(frame_class, WidgetBase):
-                    if not isinstance(frame_class, ABC) and "WidgetBase" not in frame.code_context[0]:
+                    if not isinstance(frame_class, ABC) and frame is not forwarding_frame:
                         named_part = '' if named_instance is None or named_instance_used is True else f"[{named_instance}]"
                         named_instance_used = True
                         if issubclass(frame_class, BlendState):
                             self._key_prefix = f"{frame_class.__name__}{named_part}"
                         else:
-                            sibling_index = 0
-                            while f"{frame_class.__name__}{named_part}[{sibling_index}].{self._key_prefix}" in used_key_prefixes:
-                                sibling_index += 1
+                            sibling_key = (self._key_prefix, frame_class.__name__, named_part)
+                            sibling_index = sibling_counters.get(sibling_key, 0)
+                            sibling_counters[sibling_key] = sibling_index + 1
                             self._key_prefix = f"{frame_class.__name__}{named_part}[{sibling_index}].{self._key_prefix}"
-                            used_key_prefixes.add(self._key_prefix)
                 else:
                     break
+            frame = frame.f_back
     
     def _session_state_for_this_widget(self):
         """
-        Returns a dictionary of session state for this widget
+        Returns a dictionary of session state for this widget and the widgets nested within it.
+        This covers every key built with _full_key, including those written by bound Streamlit fields.
+        """
+        return {
+            k: st.session_state[k]
+            for prefix, keys in st.session_state.get(_KEY_INDEX_KEY, {}).items()
+            if prefix.startswith(self._key_prefix)
+            for k in keys
+            if k in st.session_state
+        }
+
+    def _register_keys(self, full_keys: Iterable[str], persist: bool):
         """
-        return {k:v for k,v in st.session_state.items() if k.startswith(self._key_prefix)}
+        Records full keys against this widget's prefix, so that its session state can be found without a scan.
+        Keys registered with persist=True are rewritten by prepare() on each execution.
+        """
+        prefix_keys = st.session_state.setdefault(_KEY_INDEX_KEY, {}).setdefault(self._key_prefix, {})
+        for full_key in full_keys:
+            prefix_keys[full_key] = persist or prefix_keys.get(full_key, False)
 
     def _full_key(self, key_name: str):
         """
         Builds the full key from a simple name, by adding the prefix unique to the component's instantation path
         """
-        return f"{self._key_prefix}{key_name}"
+        if key_name not in self._full_keys:
+            self._full_keys[key_name] = f"{self._key_prefix}{key_name}"
+            self._register_keys((self._full_keys[key_name],), persist=False)
+        return self._full_keys[key_name]
 
     def _get_session_state(self, key_name: str):
         """
@@ -91,34 +178,29 @@ class WidgetBase(ABC):
         return st.session_state[self._full_key(key_name)]
 
     def _set_session_state(self, key_name: str, value: any):
+        self._register_keys((self._full_key(key_name),), persist=True)
         st.session_state[self._full_key(key_name)] = value
 
     def _apply_session_state_defaults(self, defaults: Dict[str, any]):
         """
         Initialises the session state for the first time with a dictionary of defaults.
-        The keys will be converted to their full path within this method.
+        The keys will be converted to their full path within this method, and registered as needing to be persisted.
         """
-        for k, v in defaults.items():
-            full_key = self._full_key(k)
-            if full_key not in st.session_state:
-                # first, we register the key as needing to be persisted
-                if _PERSIST_STATE_KEY not in st.session_state:
-                    st.session_state[_PERSIST_STATE_KEY] = set()
-                st.session_state[_PERSIST_STATE_KEY].add(full_key)
-                st.session_state[full_key] = v
+        full_defaults = {self._full_key(k): v for k, v in defaults.items()}
+        self._register_keys(full_defaults.keys(), persist=True)
+        new_items = {k: v for k, v in full_defaults.items() if k not in st.session_state}
+        if new_items:
+            st.session_state.update(new_items)
 
     def render(self):
         if (
             "show_component_filenames" in st.session_state
             and st.session_state["show_component_filenames"] is True
         ):
-            current_class_path = inspect.getsourcefile(self.__class__)
-            for f in inspect.stack():
-                if f.filename.endswith("Launch.py"):
-                    current_class_path = current_class_path.replace(
-                        os.path.dirname(f.filename), ""
-                    )
-                    break
+            current_class_path = _class_source_file(self.__class__)
+            launch_directory = _launch_directory()
+            if launch_directory is not None:
+                current_class_path = current_class_path.replace(launch_directory, "")
             st.markdown(f"""```{current_class_path}```""")
 
 